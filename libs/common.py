@@ -6,6 +6,9 @@ import os
 import ast
 import sys
 import imp
+import time
+import threading
+import collections
 import configparser
 PY3 = False
 if sys.version_info > (3,):
@@ -133,6 +136,16 @@ def parseDir(directory, recursive=False):
     recursive - If true it will recursively find files.
     """
     filelist = []
+    if hasattr(os, 'scandir'):
+        # scandir (Python 3.5+) gets the file type along with each name, so
+        # directories are told apart without an extra stat() per entry
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                if recursive:
+                    filelist.extend(parseDir(entry.path, recursive))
+            else:
+                filelist.append(entry.path)
+        return filelist
     for item in os.listdir(directory):
         item = os.path.join(directory, item)
         if os.path.isdir(item):
@@ -222,6 +235,63 @@ def hashfile(fname, hasher, blocksize=65536):
     return hasher.hexdigest()
 
 
+class TTLCache(object):
+    """
+    A small thread safe cache whose entries expire ttl seconds after they were
+    set. Once maxsize entries are stored, setting a new one evicts the oldest.
+
+    maxsize - The maximum number of entries to keep
+    ttl - The number of seconds an entry stays valid
+    timer - Function returning the current time in seconds
+    """
+    def __init__(self, maxsize=128, ttl=300, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value stored for key, or default if it is missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires <= self.timer():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        """Stores value for key, restarting its ttl."""
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (self.timer() + self.ttl, value)
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value, or default if it is missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires <= self.timer():
+                return default
+            return value
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
 def sshconnect(hostname, port=22, username=None, password=None, pkey=None, key_filename=None, timeout=None, allow_agent=True, look_for_keys=True, compress=False, sock=None):
     """A wrapper for paramiko, returns a SSHClient after it connects."""
     client = paramiko.SSHClient()
@@ -62,6 +62,9 @@ class Database(object):
         'username': 'multiscanner',
         'password': 'CHANGEME'
     }
+    # Maximum number of ids per query in the *_bulk methods; keeps us under
+    # SQLite's limit on the number of bound parameters
+    BULK_QUERY_SIZE = 500
 
     def __init__(self, config=None, configfile=CONFIG_FILE, regenconfig=False):
         self.db_connection_string = None
@@ -180,6 +183,23 @@ class Database(object):
                     task.timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
                 return task.to_dict()
 
+    def update_tasks_bulk(self, task_ids, task_status, timestamp=None):
+        '''Updates the status (and timestamp, if given) of several tasks in a
+        single transaction. Returns the number of tasks updated.
+        '''
+        task_ids = list(task_ids)
+        values = {Task.task_status: task_status}
+        if timestamp:
+            values[Task.timestamp] = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+        updated = 0
+        with self.db_session_scope() as ses:
+            for i in range(0, len(task_ids), self.BULK_QUERY_SIZE):
+                chunk = task_ids[i:i + self.BULK_QUERY_SIZE]
+                updated += (ses.query(Task)
+                            .filter(Task.task_id.in_(chunk))
+                            .update(values, synchronize_session=False))
+        return updated
+
     def get_task(self, task_id):
         with self.db_session_scope() as ses:
             task = ses.query(Task).get(task_id)
@@ -257,20 +277,44 @@ class Database(object):
             exists in task database, otherwise None.
         '''
         with self.db_session_scope() as ses:
-            task = ses.query(Task).filter(Task.sample_id == sample_id)
             # Query for most recent task with given sample_id
-            task_alias = aliased(Task)
-            sample_subq = (ses.query(task_alias.sample_id,
-                                     func.max(task_alias.timestamp).label('ts_max'))
-                           .group_by(task_alias.sample_id)
-                           .subquery()
-                           .alias('sample_subq'))
-            query = (ses.query(Task)
-                     .join(sample_subq,
-                           and_(Task.sample_id == sample_subq.c.sample_id,
-                                Task.timestamp == sample_subq.c.ts_max)))
+            query = self._latest_tasks_query(ses, Task)
             task = query.filter(Task.sample_id == sample_id).first()
             if task:
                 return task.task_id
             else:
                 return None
+
+    def exists_bulk(self, sample_ids):
+        '''Checks which of the given sample_ids have tasks in the database,
+        using one query per BULK_QUERY_SIZE ids instead of one per id.
+
+        Returns:
+            Dictionary mapping each sample_id that has a task in the task
+            database to the task id of its most recent task. Sample_ids
+            without any tasks are left out.
+        '''
+        sample_ids = list(sample_ids)
+        task_ids = {}
+        with self.db_session_scope() as ses:
+            query = self._latest_tasks_query(ses, Task.sample_id, Task.task_id)
+            for i in range(0, len(sample_ids), self.BULK_QUERY_SIZE):
+                chunk = sample_ids[i:i + self.BULK_QUERY_SIZE]
+                for sample_id, task_id in query.filter(Task.sample_id.in_(chunk)):
+                    task_ids[sample_id] = task_id
+        return task_ids
+
+    def _latest_tasks_query(self, ses, *entities):
+        '''Returns a query for the given entities restricted to the most
+        recent task of each sample.
+        '''
+        task_alias = aliased(Task)
+        sample_subq = (ses.query(task_alias.sample_id,
+                                 func.max(task_alias.timestamp).label('ts_max'))
+                       .group_by(task_alias.sample_id)
+                       .subquery()
+                       .alias('sample_subq'))
+        return (ses.query(*entities)
+                .join(sample_subq,
+                      and_(Task.sample_id == sample_subq.c.sample_id,
+                           Task.timestamp == sample_subq.c.ts_max)))
@@ -1,8 +1,10 @@
+import hashlib
 import os
 import shutil
 import sys
 import json
 import mock
+import zipfile
 try:
     from StringIO import StringIO as BytesIO
 except:
@@ -41,6 +43,7 @@ if not os.path.isdir(TEST_UPLOAD_FOLDER):
     print('Creating upload dir')
     os.makedirs(TEST_UPLOAD_FOLDER)
 api.api_config['api']['upload_folder'] = TEST_UPLOAD_FOLDER
+api.upload_folder = TEST_UPLOAD_FOLDER
 
 TEST_REPORT = {
     'MD5': '96b47da202ddba8d7a6b91fecbf89a41',
@@ -67,6 +70,11 @@ class APITestCase(unittest.TestCase):
         self.app = api.app.test_client()
         # Replace the real production DB w/ a testing DB
         api.db = self.sql_db
+        api.exists_cache.clear()
+        api.modules_cache.clear()
+        api.report_cache.clear()
+        api.pdf_cache.clear()
+        api.tags_cache.clear()
         if not os.path.isdir(TEST_UPLOAD_FOLDER):
             os.makedirs(TEST_UPLOAD_FOLDER)
 
@@ -103,6 +111,12 @@ class TestURLCase(APITestCase):
         resp = self.app.get('/api/v1/modules').get_data().decode('utf-8')
         self.assertIn('Modules', resp)
 
+    def test_get_modules_cached(self):
+        with mock.patch('api.multiscanner.parseDir', return_value=[]) as mock_parse:
+            self.app.get('/api/v1/modules')
+            self.app.get('/api/v1/modules')
+        self.assertEqual(mock_parse.call_count, 1)
+
 
 class TestTaskCreateCase(APITestCase):
     def setUp(self):
@@ -166,6 +180,18 @@ class TestTaskUpdateCase(APITestCase):
         self.assertEqual(resp.status_code, api.HTTP_OK)
         self.assertDictEqual(json.loads(resp.get_data().decode()), expected_response)
 
+    def test_get_task_timestamp_format(self):
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        resp = self.app.get('/api/v1/tasks/1')
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        self.assertEqual(resp.mimetype, 'application/json')
+        task = json.loads(resp.get_data().decode())['Task']
+        self.assertEqual(task['timestamp'], '2018-01-01 12:00:00.000001')
+
     def test_delete_nonexistent_task(self):
         expected_response = api.TASK_NOT_FOUND
         resp = self.app.delete('/api/v1/tasks/2')
@@ -186,6 +212,27 @@ class TestTaskDeleteCase(APITestCase):
         self.assertEqual(resp.status_code, api.HTTP_OK)
         self.assertDictEqual(json.loads(resp.get_data().decode()), expected_response)
 
+    def test_delete_task_clears_exists_cache(self):
+        sha256 = '114d70ba7d04c76d8c217c970f99682025c89b1a6ffe91eb9045653b4b954eb9'
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        resp = self.app.get('/api/v1/tasks/search?sha256=' + sha256)
+        self.assertDictEqual(json.loads(resp.get_data().decode()), {'TaskID': 1})
+
+        self.app.delete('/api/v1/tasks/1')
+        resp = self.app.get('/api/v1/tasks/search?sha256=' + sha256)
+        self.assertDictEqual(json.loads(resp.get_data().decode()), api.TASK_NOT_FOUND)
+
+    def test_resubmit_ignores_exists_cache(self):
+        # A stale entry, e.g. for a task another API process deleted
+        sha256 = '114d70ba7d04c76d8c217c970f99682025c89b1a6ffe91eb9045653b4b954eb9'
+        api.exists_cache.set(sha256, 42)
+        resp = post_file(self.app)
+        self.assertEqual(json.loads(resp.get_data().decode()), {'Message': {'task_ids': [1]}})
+
     def test_delete_nonexistent_task(self):
         expected_response = api.TASK_NOT_FOUND
         resp = self.app.delete('/api/v1/tasks/2')
@@ -211,6 +258,138 @@ class TestReportCase(APITestCase):
         self.assertEqual(resp.status_code, api.HTTP_OK)
         self.assertDictEqual(json.loads(resp.get_data().decode()), expected_response)
 
+    @mock.patch('api.handler')
+    def test_get_report_ssdeep_links(self, mock_handler):
+        sha256 = '114d70ba7d04c76d8c217c970f99682025c89b1a6ffe91eb9045653b4b954eb9'
+        report = dict(TEST_REPORT)
+        report['ssdeep'] = {'matches': {sha256: 100, 'deadbeef': 50}}
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        mock_handler.get_report.return_value = report
+        resp = self.app.get('/api/v1/tasks/1/report')
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        matches = json.loads(resp.get_data().decode())['Report']['ssdeep']['matches']
+        link = '<a target="_blank" href="{}/report/1">{}</a>'.format(api.web_loc, sha256)
+        self.assertDictEqual(matches, {link: 100, 'deadbeef': 50})
+
+    @mock.patch('api.DISTRIBUTED', True)
+    @mock.patch('api.render_pdf_celery')
+    def test_get_pdf_async(self, mock_render):
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        pdf_path = os.path.join(TEST_UPLOAD_FOLDER, 'pdf', '1.pdf')
+        marker = pdf_path + api.PDF_PENDING_SUFFIX
+        with mock.patch('api.rendered_pdf_path', return_value=pdf_path):
+            resp = self.app.get('/api/v1/tasks/1/pdf?async=t')
+            self.assertEqual(resp.status_code, api.HTTP_ACCEPTED)
+            mock_render.delay.assert_called_once_with(1)
+            self.assertTrue(os.path.isfile(marker))
+
+            # Polling again doesn't queue a second render
+            self.app.get('/api/v1/tasks/1/pdf?async=t')
+            self.assertEqual(mock_render.delay.call_count, 1)
+
+            # A render that never finished is queued again
+            os.utime(marker, (0, 0))
+            self.app.get('/api/v1/tasks/1/pdf?async=t')
+            self.assertEqual(mock_render.delay.call_count, 2)
+
+            # A failed render is reported instead of being queued again
+            os.remove(marker)
+            failed = pdf_path + api.PDF_FAILED_SUFFIX
+            open(failed, 'w').close()
+            resp = self.app.get('/api/v1/tasks/1/pdf?async=t')
+            self.assertEqual(resp.status_code, api.HTTP_SERVER_ERROR)
+            self.assertEqual(mock_render.delay.call_count, 2)
+            self.assertFalse(os.path.isfile(marker))
+
+            # ...until PDF_RENDER_TIMEOUT has passed
+            os.utime(failed, (0, 0))
+            resp = self.app.get('/api/v1/tasks/1/pdf?async=t')
+            self.assertEqual(resp.status_code, api.HTTP_ACCEPTED)
+            self.assertEqual(mock_render.delay.call_count, 3)
+
+            os.remove(marker)
+            with open(pdf_path, 'wb') as pdf_fh:
+                pdf_fh.write(b'%PDF')
+            resp = self.app.get('/api/v1/tasks/1/pdf?async=t')
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        self.assertEqual(resp.get_data(), b'%PDF')
+        # Left in place for other API processes
+        self.assertTrue(os.path.isfile(pdf_path))
+
+    @mock.patch('api.cuckoo_session')
+    @mock.patch('api.handler')
+    def test_get_maec_report(self, mock_handler, mock_session):
+        report = dict(TEST_REPORT)
+        report['Cuckoo Sandbox'] = {'info': {'id': 7}}
+        mock_handler.get_report.return_value = report
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        mock_session.get.return_value.ok = True
+        mock_session.get.return_value.content = b'{"maec": 1}'
+        resp = self.app.get('/api/v1/tasks/1/maec')
+        self.assertEqual(resp.get_data(), b'{"maec": 1}')
+        self.assertEqual(resp.headers['Content-Type'], 'application/json')
+
+    @mock.patch('api.handler')
+    def test_get_report_cached(self, mock_handler):
+        report = dict(TEST_REPORT)
+        report['ssdeep'] = {'chunksize': 3, 'matches': {'deadbeef': 50}}
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        mock_handler.get_report.return_value = report
+        first = self.app.get('/api/v1/tasks/1/report').get_data()
+        second = self.app.get('/api/v1/tasks/1/report').get_data()
+        self.assertEqual(mock_handler.get_report.call_count, 1)
+        self.assertEqual(first, second)
+        # Pre-processing must not change the cached report
+        self.assertEqual(report['ssdeep'], {'chunksize': 3, 'matches': {'deadbeef': 50}})
+
+    @mock.patch('api.handler')
+    def test_get_pdf_cached(self, mock_handler):
+        mock_handler.get_report.return_value = TEST_REPORT
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        pdf_generator = mock.MagicMock()
+        pdf_generator.create_pdf_document.return_value = b'%PDF'
+        with mock.patch.dict(sys.modules, {'utils.pdf_generator': pdf_generator}):
+            self.app.get('/api/v1/tasks/1/pdf')
+            resp = self.app.get('/api/v1/tasks/1/pdf')
+        self.assertEqual(resp.get_data(), b'%PDF')
+        self.assertEqual(pdf_generator.create_pdf_document.call_count, 1)
+
+    @mock.patch('api.handler')
+    def test_get_pdf_after_delete(self, mock_handler):
+        mock_handler.get_report.return_value = TEST_REPORT
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        pdf_generator = mock.MagicMock()
+        pdf_generator.create_pdf_document.return_value = b'%PDF'
+        with mock.patch.dict(sys.modules, {'utils.pdf_generator': pdf_generator}):
+            self.app.get('/api/v1/tasks/1/pdf')
+            self.app.delete('/api/v1/tasks/1')
+            resp = self.app.get('/api/v1/tasks/1/pdf')
+        self.assertEqual(resp.status_code, api.HTTP_NOT_FOUND)
+
     def test_get_nonexistent_report(self):
         expected_response = api.TASK_NOT_FOUND
         resp = self.app.get('/api/v1/tasks/42/report')
@@ -264,6 +443,18 @@ class TestTagsNotesCase(APITestCase):
         args, kwargs = mock_handler.add_tag.call_args_list[0]
         self.assertEqual(args[1], 'foo')
 
+    @mock.patch('api.handler')
+    def test_get_tags_cached(self, mock_handler):
+        mock_handler.get_tags.return_value = {'foo': 1}
+        self.app.get('/api/v1/tags/')
+        resp = self.app.get('/api/v1/tags/')
+        self.assertEqual(json.loads(resp.get_data().decode()), {'Tags': {'foo': 1}})
+        self.assertEqual(mock_handler.get_tags.call_count, 1)
+        # Adding a tag invalidates the cached list
+        self.app.post('/api/v1/tasks/1/tags', data={'tag': 'bar'})
+        self.app.get('/api/v1/tags/')
+        self.assertEqual(mock_handler.get_tags.call_count, 2)
+
     @mock.patch('api.handler')
     def test_remove_tags(self, mock_handler):
         self.app.delete('/api/v1/tasks/1/tags', data={'tag': 'foo'})
@@ -272,6 +463,15 @@ class TestTagsNotesCase(APITestCase):
         self.assertEqual(args[0], '114d70ba7d04c76d8c217c970f99682025c89b1a6ffe91eb9045653b4b954eb9')
         self.assertEqual(args[1], 'foo')
 
+    @mock.patch('api.handler')
+    def test_get_notes(self, mock_handler):
+        mock_handler.get_notes.return_value = {'hits': {'hits': [
+            {'_id': '1', '_source': {'text': '<b>hi</b>'}},
+        ]}}
+        resp = self.app.get('/api/v1/tasks/1/notes')
+        self.assertEqual(json.loads(resp.get_data().decode()),
+                         [{'_id': '1', '_source': {'text': '&lt;b&gt;hi&lt;/b&gt;'}}])
+
     @mock.patch('api.handler')
     def test_add_notes(self, mock_handler):
         self.app.post('/api/v1/tasks/1/notes', data={'text': 'foo'})
@@ -296,3 +496,130 @@ class TestTagsNotesCase(APITestCase):
         args, kwargs = mock_handler.delete_note.call_args_list[0]
         self.assertEqual(args[0], '114d70ba7d04c76d8c217c970f99682025c89b1a6ffe91eb9045653b4b954eb9')
         self.assertEqual(args[1], '1')
+
+
+class TestFilesCase(APITestCase):
+    def setUp(self):
+        super(self.__class__, self).setUp()
+        api.multiscanner_celery.delay = mock_delay
+        # populate the DB and upload folder w/ a sample
+        post_file(self.app)
+        self.sha256 = '114d70ba7d04c76d8c217c970f99682025c89b1a6ffe91eb9045653b4b954eb9'
+
+    def test_get_raw_file(self):
+        resp = self.app.get('/api/v1/files/{}?raw=t'.format(self.sha256))
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        self.assertEqual(resp.get_data(), b'my file contents')
+
+    def test_get_raw_file_range(self):
+        resp = self.app.get('/api/v1/files/{}?raw=t'.format(self.sha256),
+                            headers={'Range': 'bytes=0-1'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.get_data(), b'my')
+
+    def test_get_zipped_file(self):
+        resp = self.app.get('/api/v1/files/{}'.format(self.sha256))
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        self.assertEqual(resp.headers['Content-Type'], 'application/zip; charset=UTF-8')
+        if api.pyzipper:
+            zf = api.pyzipper.AESZipFile(BytesIO(resp.get_data()))
+        else:
+            zf = zipfile.ZipFile(BytesIO(resp.get_data()))
+        self.assertEqual(zf.namelist(), [self.sha256 + '.bin'])
+        self.assertEqual(zf.read(self.sha256 + '.bin', pwd=b'infected'), b'my file contents')
+
+    @mock.patch('api.handler')
+    def test_get_task_file_defaults_to_zip(self, mock_handler):
+        mock_handler.get_report.return_value = {'SHA256': self.sha256}
+        self.sql_db.update_task(
+            task_id=1,
+            task_status='Complete',
+        )
+        resp = self.app.get('/api/v1/tasks/1/file')
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        self.assertEqual(resp.headers['Content-Type'], 'application/zip; charset=UTF-8')
+
+    def test_get_nonexistent_file(self):
+        resp = self.app.get('/api/v1/files/{}'.format('0' * 64))
+        self.assertEqual(resp.status_code, api.HTTP_NOT_FOUND)
+
+    def test_get_file_invalid_sha256(self):
+        resp = self.app.get('/api/v1/files/..')
+        self.assertEqual(resp.status_code, api.HTTP_NOT_FOUND)
+
+    @mock.patch('api.pyzipper', None)
+    def test_get_zipped_file_without_pyzipper(self):
+        resp = self.app.get('/api/v1/files/{}'.format(self.sha256))
+        self.assertEqual(resp.status_code, api.HTTP_OK)
+        zf = zipfile.ZipFile(BytesIO(resp.get_data()))
+        self.assertEqual(zf.namelist(), [self.sha256 + '.bin'])
+        self.assertEqual(zf.read(self.sha256 + '.bin', pwd=b'infected'), b'my file contents')
+
+    @mock.patch('api.pyzipper', None)
+    @mock.patch('api._call_with_timeout')
+    def test_get_zipped_file_timeout(self, mock_call):
+        mock_call.return_value = None
+        resp = self.app.get('/api/v1/files/{}'.format(self.sha256))
+        self.assertEqual(resp.status_code, api.HTTP_SERVER_ERROR)
+        self.assertEqual(json.loads(resp.get_data().decode('utf-8')), {'Error': 'Process timed out'})
+
+    def test_call_with_timeout(self):
+        self.assertEqual(api._call_with_timeout(['true'], 5), 0)
+        self.assertIsNone(api._call_with_timeout(['sleep', '5'], 0.1))
+
+
+class TestArchiveCase(APITestCase):
+    def setUp(self):
+        super(self.__class__, self).setUp()
+        api.multiscanner_celery.delay = mock_delay
+
+    def post_archive(self, **form):
+        with open(os.path.join(CWD, 'files', '345.zip'), 'rb') as f:
+            data = {'file': (BytesIO(f.read()), '345.zip'), 'archive-analyze': 'true'}
+        data.update(form)
+        return self.app.post('/api/v1/tasks', data=data)
+
+    def test_extract_archive(self):
+        resp = self.post_archive()
+        self.assertEqual(resp.status_code, api.HTTP_CREATED)
+        self.assertEqual(json.loads(resp.get_data().decode()), {'Message': {'task_ids': [1]}})
+        self.assertEqual(self.sql_db.get_task(1).sample_id,
+                         'da70dfa4d9f95ac979f921e8e623358236313f334afcd06cddf8a5621cf6a1e9')
+
+    def test_extract_archives_same_member_name(self):
+        for contents in (b'AAAA', b'BBBB'):
+            archive = BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.writestr('sample.txt', contents)
+            archive.seek(0)
+            resp = self.app.post(
+                '/api/v1/tasks',
+                data={'file': (archive, 'sample.zip'), 'archive-analyze': 'true'})
+            self.assertEqual(resp.status_code, api.HTTP_CREATED)
+        # Extracting the second archive must not overwrite the first sample
+        with open(os.path.join(TEST_UPLOAD_FOLDER, hashlib.sha256(b'AAAA').hexdigest()), 'rb') as f:
+            self.assertEqual(f.read(), b'AAAA')
+        with open(os.path.join(TEST_UPLOAD_FOLDER, hashlib.sha256(b'BBBB').hexdigest()), 'rb') as f:
+            self.assertEqual(f.read(), b'BBBB')
+
+    @mock.patch('api.DISTRIBUTED', True)
+    @mock.patch('api.group')
+    @mock.patch('api.multiscanner_celery')
+    def test_extract_archive_distributed(self, mock_celery, mock_group):
+        resp = self.post_archive()
+        self.assertEqual(resp.status_code, api.HTTP_CREATED)
+        # Members are published together rather than one delay() each
+        self.assertFalse(mock_celery.delay.called)
+        self.assertEqual(mock_celery.s.call_count, 1)
+        mock_group.assert_called_once_with([mock_celery.s.return_value])
+        mock_group.return_value.apply_async.assert_called_once_with()
+
+    @mock.patch('api.extract_archive_celery')
+    def test_extract_archive_async(self, mock_extract):
+        mock_extract.delay.return_value.id = 'abc'
+        resp = self.post_archive(**{'archive-async': 'true'})
+        self.assertEqual(resp.status_code, api.HTTP_ACCEPTED)
+        self.assertEqual(json.loads(resp.get_data().decode()), {'Message': {'archive_task_id': 'abc'}})
+        args, kwargs = mock_extract.delay.call_args
+        self.assertTrue(os.path.isfile(args[0]))
+        self.assertEqual(self.sql_db.get_all_tasks(), [])
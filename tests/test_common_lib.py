@@ -56,3 +56,46 @@ def test_parseDir():
     result = common.parseDir(path, recursive=False)
     expected = [os.path.join(path, '1.1.txt'), os.path.join(path, '1.2.txt')]
     assert result == expected
+
+class _FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+def test_ttlcache_get_set():
+    cache = common.TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', 2) == 2
+
+def test_ttlcache_expires():
+    timer = _FakeTimer()
+    cache = common.TTLCache(maxsize=2, ttl=10, timer=timer)
+    cache.set('a', 1)
+    timer.now = 9
+    assert cache.get('a') == 1
+    timer.now = 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_ttlcache_evicts_oldest():
+    cache = common.TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('a', 3)
+    cache.set('c', 4)
+    assert cache.get('b') is None
+    assert cache.get('a') == 3
+    assert cache.get('c') == 4
+
+def test_ttlcache_pop_clear():
+    cache = common.TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    cache.clear()
+    assert len(cache) == 0
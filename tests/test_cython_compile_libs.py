@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import sysconfig
+import tempfile
+MS_WD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.join(MS_WD, 'utils') not in sys.path:
+    sys.path.insert(0, os.path.join(MS_WD, 'utils'))
+
+import cython_compile_libs
+
+
+def _touch(path, mtime):
+    open(path, 'w').close()
+    os.utime(path, (mtime, mtime))
+
+
+def _compiled_path(base):
+    ext_suffix = sysconfig.get_config_var('EXT_SUFFIX') or '.so'
+    return base + ext_suffix
+
+
+class TestUpToDate(object):
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'lib')
+        self.source = self.base + '.py'
+        _touch(self.source, 1000)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing_module(self):
+        assert not cython_compile_libs._up_to_date(self.source)
+
+    def test_current_module(self):
+        _touch(_compiled_path(self.base), 2000)
+        assert cython_compile_libs._up_to_date(self.source)
+
+    def test_stale_module(self):
+        _touch(_compiled_path(self.base), 500)
+        assert not cython_compile_libs._up_to_date(self.source)
+
+    def test_other_interpreter_module(self):
+        other = self.base + '.cpython-20-x86_64-linux-gnu.so'
+        assert other != _compiled_path(self.base)
+        _touch(other, 2000)
+        assert not cython_compile_libs._up_to_date(self.source)
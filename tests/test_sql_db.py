@@ -7,6 +7,7 @@ import sys
 import json
 import magic
 import unittest
+from datetime import datetime
 
 CWD = os.path.dirname(os.path.abspath(__file__))
 MS_WD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -130,6 +131,19 @@ class TestTaskManipulation(unittest.TestCase):
         self.assertDictEqual(resp, self.sql_db.get_task(1).to_dict())
         self.assertDictEqual(resp, {'task_id': 1, 'sample_id': None, 'task_status': 'Complete', 'timestamp': None})
 
+    def test_update_tasks_bulk(self):
+        self.sql_db.add_task()
+        resp = self.sql_db.update_tasks_bulk(
+            task_ids=[1, 2],
+            task_status='Complete',
+            timestamp='2018-01-01T12:00:00.000001',
+        )
+        self.assertEqual(resp, 2)
+        for task_id in [1, 2]:
+            task = self.sql_db.get_task(task_id)
+            self.assertEqual(task.task_status, 'Complete')
+            self.assertEqual(task.timestamp, datetime(2018, 1, 1, 12, 0, 0, 1))
+
     def test_delete_task(self):
         deleted = self.sql_db.delete_task(task_id=1)
         self.assertTrue(deleted)
@@ -166,6 +180,41 @@ class TestGetAllTasks(unittest.TestCase):
             drop_db_table(self.sql_db.db_engine)
 
 
+class TestTaskExists(unittest.TestCase):
+    def setUp(self):
+        self.sql_db = Database(config=DB_CONF)
+        self.sql_db.init_db()
+        self.sql_db.add_task(sample_id='a', task_status='Complete',
+                             timestamp=datetime(2018, 1, 1))
+        self.sql_db.add_task(sample_id='a', task_status='Complete',
+                             timestamp=datetime(2018, 1, 2))
+        self.sql_db.add_task(sample_id='b', task_status='Complete',
+                             timestamp=datetime(2018, 1, 1))
+
+    def test_exists(self):
+        self.assertEqual(self.sql_db.exists('a'), 2)
+        self.assertEqual(self.sql_db.exists('b'), 3)
+        self.assertEqual(self.sql_db.exists('c'), None)
+
+    def test_exists_bulk(self):
+        resp = self.sql_db.exists_bulk(['a', 'b', 'c'])
+        self.assertDictEqual(resp, {'a': 2, 'b': 3})
+
+    def test_exists_bulk_many(self):
+        sample_ids = ['a'] + [str(i) for i in range(1000)] + ['b']
+        resp = self.sql_db.exists_bulk(sample_ids)
+        self.assertDictEqual(resp, {'a': 2, 'b': 3})
+
+    def test_exists_bulk_empty(self):
+        self.assertDictEqual(self.sql_db.exists_bulk([]), {})
+
+    def tearDown(self):
+        if DB_CONF['db_type'] == 'sqlite':
+            os.remove(TEST_DB_PATH)
+        else:
+            drop_db_table(self.sql_db.db_engine)
+
+
 class TestStressTest(unittest.TestCase):
     def setUp(self):
         self.sql_db = Database(config=DB_CONF)
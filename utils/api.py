@@ -13,6 +13,9 @@ GET /api/v1/tasks ---> Receive list of tasks in MultiScanner
 POST /api/v1/tasks ---> POST file and receive report id
     Sample POST usage:
         curl -i -X POST http://localhost:8080/api/v1/tasks -F file=@/bin/ls
+    In distributed mode, archives posted with archive-analyze=true and
+    archive-async=true are extracted by a worker instead; the response is
+    202 with the id of the extraction job rather than a list of task ids.
 GET /api/v1/tasks/<task_id> ---> receive task in JSON format
 DELETE /api/v1/tasks/<task_id> ----> delete task_id
 GET /api/v1/tasks/search/ ---> receive list of most recent report for matching samples
@@ -25,6 +28,9 @@ PUT /api/v1/tasks/<task_id>/notes/<note_id> ---> Edit a note
 DELETE /api/v1/tasks/<task_id>/notes/<note_id> ---> Delete a note
 GET /api/v1/tasks/<task_id>/report?d={t|f}---> receive report in JSON, set d=t to download
 GET /api/v1/tasks/<task_id>/pdf ---> Receive PDF report
+    In distributed mode, add async=t to have a worker render the PDF; the
+    response is 202 until it is ready, then the PDF as usual.
+    Rendered PDFs are kept in a 'pdf' folder under upload_folder for a day.
 POST /api/v1/tasks/<task_id>/tags ---> Add tags to task
 DELETE /api/v1/tasks/<task_id>/tags ---> Remove tags from task
 GET /api/v1/analytics/ssdeep_compare---> Run ssdeep.compare analytic
@@ -43,21 +49,36 @@ import sys
 import time
 import hashlib
 import codecs
+import io
 import configparser
 import json
 import multiprocessing
 import subprocess
 import queue
+import re
 import shutil
+import signal
+import tempfile
+import threading
+import collections
+import uuid
 from datetime import datetime
 from flask_cors import CORS
-from flask import Flask, jsonify, make_response, request, abort
+from flask import Flask, jsonify, make_response, request, abort, send_file
 from flask.json import JSONEncoder
 from jinja2 import Markup
 from six import PY3
-import rarfile
 import zipfile
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pyzipper
+except ImportError:
+    pyzipper = None
 
 MS_WD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if os.path.join(MS_WD, 'storage') not in sys.path:
@@ -73,15 +94,60 @@ import multiscanner
 import sql_driver as database
 import elasticsearch_storage
 import common
-from utils.pdf_generator import create_pdf_document
 
 TASK_NOT_FOUND = {'Message': 'No task or report with that ID found!'}
 INVALID_REQUEST = {'Message': 'Invalid request parameters'}
 
 HTTP_OK = 200
 HTTP_CREATED = 201
+HTTP_ACCEPTED = 202
 HTTP_BAD_REQUEST = 400
 HTTP_NOT_FOUND = 404
+HTTP_SERVER_ERROR = 500
+
+# Read uploaded files in 1 MiB chunks when hashing them
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# First letters of query string values that count as true, e.g. ?raw=t
+TRUE_VALUES = frozenset(['t', 'y', '1'])
+
+# Size and lifetime (in seconds) of the sample_id -> task_id cache
+EXISTS_CACHE_SIZE = 4096
+EXISTS_CACHE_TTL = 300
+
+# Size and lifetime (in seconds) of the cache of completed reports fetched
+# from storage. Kept short since the ssdeep analytic updates stored reports.
+REPORT_CACHE_SIZE = 256
+REPORT_CACHE_TTL = 60
+
+# Number of rendered PDF reports to keep; they expire with REPORT_CACHE_TTL
+PDF_CACHE_SIZE = 32
+
+# Seconds before a PDF render handed to a worker is assumed lost and re-sent,
+# and for which a failed render is reported instead of being re-sent
+PDF_RENDER_TIMEOUT = 300
+
+# Seconds to reuse the module list and ENABLED flags served by /api/v1/modules
+MODULES_CACHE_TTL = 60
+
+# Seconds to reuse the list of tags in use served by /api/v1/tags/
+TAGS_CACHE_TTL = 30
+
+# Seconds to wait for Cuckoo to accept a connection and to send a MAEC report
+CUCKOO_TIMEOUT = (3, 30)
+# Connections to Cuckoo kept open for reuse
+CUCKOO_POOL_SIZE = 32
+
+# Samples are stored under their SHA256, so anything else can't name one
+SHA256_RE = re.compile(r'[0-9a-fA-F]{64}\Z')
+
+# Seconds to let /usr/bin/zip run before giving up on it
+ZIP_TIMEOUT = 30
+
+# Report sections and the keys _pre_process() removes from them
+REPORT_STRIP_KEYS = (
+    ('ssdeep', ('chunksize', 'chunk', 'double_chunk')),
+)
 
 DEFAULTCONF = {
     'host': 'localhost',
@@ -96,17 +162,61 @@ DEFAULTCONF = {
 }
 
 
+def _json_default(obj):
+    '''Serialize datetimes as UTC strings, e.g. 2018-01-01 12:00:00.000001.'''
+    if isinstance(obj, datetime):
+        if obj.utcoffset() is not None:
+            obj = obj - obj.utcoffset()
+        return str(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
 # Customize timestamp format output of jsonify()
 class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, datetime):
-            if obj.utcoffset() is not None:
-                obj = obj - obj.utcoffset()
-            return str(obj)
-        else:
+        try:
+            return _json_default(obj)
+        except TypeError:
             return JSONEncoder.default(self, obj)
 
 
+def ojsonify(obj):
+    '''
+    Drop-in replacement for jsonify() on endpoints returning large reports.
+    Serializes with orjson if it is installed, which is several times faster
+    than the stdlib json module used by jsonify(). Timestamps are formatted
+    the same way as CustomJSONEncoder.
+    '''
+    if orjson is None:
+        return jsonify(obj)
+    response = make_response(orjson.dumps(
+        obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATETIME))
+    response.mimetype = 'application/json'
+    return response
+
+
+def canned_response(body, status=HTTP_OK):
+    '''
+    Return a JSON response with a body that was serialized ahead of time,
+    for messages that never change.
+    '''
+    response = make_response(body, status)
+    response.mimetype = 'application/json'
+    return response
+
+
+# Serialized once at import, as they're returned unchanged on every call
+INVALID_REQUEST_BODY = json.dumps(INVALID_REQUEST)
+TASK_NOT_FOUND_BODY = json.dumps(TASK_NOT_FOUND)
+CONNECTED_BODY = json.dumps({'Message': 'True'})
+DELETED_BODY = json.dumps({'Message': 'Deleted'})
+TAG_ADDED_BODY = json.dumps({'Message': 'Tag Added'})
+TAG_REMOVED_BODY = json.dumps({'Message': 'Tag Removed'})
+SUCCESS_BODY = json.dumps({'Message': 'Success'})
+PDF_RENDERING_BODY = json.dumps({'Message': 'PDF report is being generated'})
+PDF_FAILED_BODY = json.dumps({'Message': 'PDF report could not be generated'})
+
+
 app = Flask(__name__)
 app.json_encoder = CustomJSONEncoder
 api_config_object = configparser.SafeConfigParser()
@@ -124,8 +234,9 @@ if not api_config_object.has_section('api') or not os.path.isfile(api_config_fil
 api_config = multiscanner.common.parse_config(api_config_object)
 
 # Needs api_config in order to function properly
-from celery_worker import multiscanner_celery, ssdeep_compare_celery
-from ssdeep_analytics import SSDeepAnalytic
+from celery import group
+from celery_worker import multiscanner_celery, ssdeep_compare_celery, extract_archive_celery, \
+    render_pdf_celery, rendered_pdf_path, PDF_PENDING_SUFFIX, PDF_FAILED_SUFFIX
 
 db = database.Database(config=api_config.get('Database'))
 # To run under Apache, we need to set up the DB outside of __main__
@@ -161,32 +272,67 @@ batch_size = api_config['api']['batch_size']
 batch_interval = api_config['api']['batch_interval']
 # Add `delete_after_scan = True` to api_config.ini to delete samples after scan has completed
 delete_after_scan = api_config['api'].get('delete_after_scan', False)
+upload_folder = api_config['api']['upload_folder']
+web_loc = api_config['api']['web_loc']
+# Add `use_x_sendfile = True` to api_config.ini when running behind a web server
+# that honors X-Sendfile, so it sends raw samples instead of Python
+app.use_x_sendfile = api_config['api'].get('use_x_sendfile', False)
+
+# Task ids of the latest task per sample_id, as returned by db.exists().
+# Entries go stale at most EXISTS_CACHE_TTL seconds after a rescan finishes.
+exists_cache = common.TTLCache(maxsize=EXISTS_CACHE_SIZE, ttl=EXISTS_CACHE_TTL)
+
+# Shared by all request threads, so connections to Cuckoo are pooled and
+# reused between MAEC report requests; urllib3's pool is thread safe
+cuckoo_session = requests.Session()
+cuckoo_session.mount('http://', HTTPAdapter(pool_maxsize=CUCKOO_POOL_SIZE))
+cuckoo_session.mount('https://', HTTPAdapter(pool_maxsize=CUCKOO_POOL_SIZE))
+
+# Created by get_ssdeep_analytic() on first use
+ssdeep_analytic = None
+ssdeep_analytic_lock = threading.Lock()
+
+# Tags in use, as returned by handler.get_tags()
+tags_cache = common.TTLCache(maxsize=1, ttl=TAGS_CACHE_TTL)
+
+# Completed reports keyed by (sample_id, timestamp). Cached reports are shared
+# between requests, so callers must copy before changing them.
+report_cache = common.TTLCache(maxsize=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL)
+# Rendered PDF bytes of completed reports, keyed by (task_id, sample_id,
+# timestamp) so a reused task id can't be served another sample's PDF
+pdf_cache = common.TTLCache(maxsize=PDF_CACHE_SIZE, ttl=REPORT_CACHE_TTL)
+
+# Response body of modules(), so the module dir and config are not re-read per request
+modules_cache = common.TTLCache(maxsize=1, ttl=MODULES_CACHE_TTL)
+
+# A submitted file waiting in work_queue for multiscanner_process()
+WorkItem = collections.namedtuple(
+    'WorkItem', ['full_path', 'original_filename', 'task_id', 'f_name', 'metadata'])
+
 
 def multiscanner_process(work_queue, exit_signal):
     '''Not used in distributed mode.
     '''
-    metadata_list = []
-    time_stamp = None
     while True:
-        time.sleep(1)
+        # Block until the first file of a batch arrives
         try:
-            metadata_list.append(work_queue.get_nowait())
-            if not time_stamp:
-                time_stamp = time.time()
-            while len(metadata_list) < batch_size:
-                metadata_list.append(work_queue.get_nowait())
+            metadata_list = [work_queue.get(timeout=batch_interval)]
         except queue.Empty:
-            if metadata_list and time_stamp:
-                if len(metadata_list) >= batch_size:
-                    pass
-                elif time.time() - time_stamp > batch_interval:
-                    pass
-                else:
-                    continue
-            else:
-                continue
+            continue
+
+        # Collect more files until the batch is full or batch_interval
+        # seconds have passed since the first one arrived
+        deadline = time.time() + batch_interval
+        while len(metadata_list) < batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                metadata_list.append(work_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
 
-        filelist = [item[0] for item in metadata_list]
+        filelist = [item.full_path for item in metadata_list]
         #modulelist = [item[5] for item in metadata_list]
         resultlist = multiscanner.multiscan(
             filelist, configfile=multiscanner.CONFIG
@@ -200,38 +346,42 @@ def multiscanner_process(work_queue, exit_signal):
             for file_name in results:
                 os.remove(file_name)
 
+        # Use the original filename as the index instead of the full path.
+        # Re-key in place so subfile reports added by multiscan() are kept.
         for item in metadata_list:
-            # Use the original filename as the index instead of the full path
-            results[item[1]] = results[item[0]]
-            del results[item[0]]
-
-            results[item[1]]['Scan Time'] = scan_time
-            results[item[1]]['Metadata'] = item[4]
-
-            db.update_task(
-                task_id=item[2],
-                task_status='Complete',
-                timestamp=scan_time,
-            )
-        metadata_list = []
+            report = results.pop(item.full_path)
+            report['Scan Time'] = scan_time
+            report['Metadata'] = item.metadata
+            results[item.original_filename] = report
+
+        db.update_tasks_bulk(
+            task_ids=[item.task_id for item in metadata_list],
+            task_status='Complete',
+            timestamp=scan_time,
+        )
 
         storage_handler.store(results, wait=False)
-
-        filelist = []
-        time_stamp = None
     storage_handler.close()
 
 
+def _parse_bool(value):
+    '''
+    Return True if a query string flag such as ?raw=t or ?d=yes is set.
+    Missing or empty values are False.
+    '''
+    return bool(value) and value[0].lower() in TRUE_VALUES
+
+
 @app.errorhandler(HTTP_BAD_REQUEST)
 def invalid_request(error):
     '''Return a 400 with the INVALID_REQUEST message.'''
-    return make_response(jsonify(INVALID_REQUEST), HTTP_BAD_REQUEST)
+    return canned_response(INVALID_REQUEST_BODY, HTTP_BAD_REQUEST)
 
 
 @app.errorhandler(HTTP_NOT_FOUND)
 def not_found(error):
     '''Return a 404 with a TASK_NOT_FOUND message.'''
-    return make_response(jsonify(TASK_NOT_FOUND), HTTP_NOT_FOUND)
+    return canned_response(TASK_NOT_FOUND_BODY, HTTP_NOT_FOUND)
 
 
 @app.route('/')
@@ -240,7 +390,7 @@ def index():
     Return a default standard message
     for testing connectivity.
     '''
-    return jsonify({'Message': 'True'})
+    return canned_response(CONNECTED_BODY)
 
 
 @app.route('/api/v1/modules', methods=['GET'])
@@ -249,20 +399,23 @@ def modules():
     Return a list of module names available for MultiScanner to use,
     and whether or not they are enabled in the config.
     '''
-    files = multiscanner.parseDir(multiscanner.MODULEDIR, True)
-    filenames = [os.path.splitext(os.path.basename(f)) for f in files]
-    module_names = [m[0] for m in filenames if m[1] == '.py']
-
-    ms_config = configparser.SafeConfigParser()
-    ms_config.optionxform = str
-    ms_config.read(multiscanner.CONFIG)
-    modules = {}
-    for module in module_names:
-        try:
-            modules[module] = ms_config.get(module, 'ENABLED')
-        except (configparser.NoSectionError, configparser.NoOptionError):
-            pass
-    return jsonify({'Modules': modules})
+    modules = modules_cache.get('modules')
+    if modules is None:
+        files = multiscanner.parseDir(multiscanner.MODULEDIR, True)
+        filenames = [os.path.splitext(os.path.basename(f)) for f in files]
+        module_names = [m[0] for m in filenames if m[1] == '.py']
+
+        ms_config = configparser.SafeConfigParser()
+        ms_config.optionxform = str
+        ms_config.read(multiscanner.CONFIG)
+        modules = {}
+        for module in module_names:
+            try:
+                modules[module] = ms_config.get(module, 'ENABLED')
+            except (configparser.NoSectionError, configparser.NoOptionError):
+                pass
+        modules_cache.set('modules', modules)
+    return ojsonify({'Modules': modules})
 
 
 @app.route('/api/v1/tasks', methods=['GET'])
@@ -272,14 +425,48 @@ def task_list():
     in the tasks DB.
     '''
 
-    return jsonify({'Tasks': db.get_all_tasks()})
+    return ojsonify({'Tasks': db.get_all_tasks()})
+
+
+def _task_exists(sample_id):
+    '''
+    Cached version of db.exists(), for read-only lookups. Only hits are
+    cached so that samples without a task are always looked up again.
+    '''
+    task_id = exists_cache.get(sample_id)
+    if task_id is None:
+        task_id = db.exists(sample_id)
+        if task_id:
+            exists_cache.set(sample_id, task_id)
+    return task_id
+
+
+def _tasks_exist(sample_ids):
+    '''
+    Cached version of db.exists_bulk(). Only sample_ids missing from the
+    cache are looked up in the database.
+    '''
+    task_ids = {}
+    missing = []
+    for sample_id in sample_ids:
+        task_id = exists_cache.get(sample_id)
+        if task_id is None:
+            missing.append(sample_id)
+        else:
+            task_ids[sample_id] = task_id
+    if missing:
+        found = db.exists_bulk(missing)
+        for sample_id, task_id in found.items():
+            exists_cache.set(sample_id, task_id)
+        task_ids.update(found)
+    return task_ids
 
 
 def search(params, get_all=False):
     # Pass search term to Elasticsearch, get back list of sample_ids
     sample_id = params.get('sha256')
     if sample_id:
-        task_id = db.exists(sample_id)
+        task_id = _task_exists(sample_id)
         if task_id:
             return { 'TaskID' : task_id }
         else:
@@ -307,7 +494,7 @@ def task_search_history():
     '''
     params = request.args.to_dict()
     resp = search(params, get_all=True)
-    return jsonify(resp)
+    return ojsonify(resp)
 
 
 @app.route('/api/v1/tasks/search', methods=['GET'])
@@ -318,7 +505,7 @@ def task_search():
     '''
     params = request.args.to_dict()
     resp = search(params)
-    return jsonify(resp)
+    return ojsonify(resp)
 
 
 @app.route('/api/v1/tasks/<int:task_id>', methods=['GET'])
@@ -329,7 +516,7 @@ def get_task(task_id):
     '''
     task = db.get_task(task_id)
     if task:
-        return jsonify({'Task': task.to_dict()})
+        return ojsonify({'Task': task.to_dict()})
     else:
         abort(HTTP_NOT_FOUND)
 
@@ -342,25 +529,45 @@ def delete_task(task_id):
     result = db.delete_task(task_id)
     if not result:
         abort(HTTP_NOT_FOUND)
-    return jsonify({'Message': 'Deleted'})
+    # The deleted task may be cached as the latest task of its sample, and
+    # SQLite may hand its id to the next task
+    exists_cache.clear()
+    clear_report_caches()
+    return canned_response(DELETED_BODY)
 
 
 def save_hashed_filename(f, zipped=False):
     '''
     Save given file to the upload folder, with its SHA256 hash as its filename.
+    Uploads are hashed while they are written out, so they are only read once.
     '''
-    f_name = hashlib.sha256(f.read()).hexdigest()
-    # Reset the file pointer to the beginning to allow us to save it
-    f.seek(0)
-
-    # TODO: should we check if the file is already there
-    # and skip this step if it is?
-    file_path = os.path.join(api_config['api']['upload_folder'], f_name)
-    full_path = os.path.join(MS_WD, file_path)
+    sha256 = hashlib.sha256()
     if zipped:
-        shutil.copy2(f.name, full_path)
-    else:
-        f.save(file_path)
+        # Already extracted into the upload folder, so it only needs hashing
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+        f_name = sha256.hexdigest()
+        full_path = os.path.join(MS_WD, upload_folder, f_name)
+        if not os.path.exists(full_path):
+            # Copy rather than link, as the next archive with a member of
+            # the same name is extracted over this one
+            shutil.copy2(f.name, full_path)
+        return (f_name, full_path)
+
+    # Write to a temporary name since the hash isn't known until the end
+    tmp_path = os.path.join(upload_folder, '.upload-' + uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    f_name = sha256.hexdigest()
+    file_path = os.path.join(upload_folder, f_name)
+    os.rename(tmp_path, file_path)
+    full_path = os.path.join(MS_WD, file_path)
     return (f_name, full_path)
 
 
@@ -372,7 +579,11 @@ def import_task(file_):
     '''
     Import a JSON report that was downloaded from MultiScanner.
     '''
-    report = json.loads(file_.read().decode('utf-8'))
+    if orjson is not None:
+        # orjson parses the raw bytes, skipping the decode to str
+        report = orjson.loads(file_.read())
+    else:
+        report = json.loads(file_.read().decode('utf-8'))
     try:
         report['Scan Time'] = datetime.strptime(report['Scan Time'], '%Y-%m-%dT%H:%M:%S.%f')
     except ValueError:
@@ -383,18 +594,23 @@ def import_task(file_):
         task_status='Complete',
         timestamp=report['Scan Time'],
     )
+    exists_cache.pop(report['SHA256'])
     storage_handler.store({report['filename']: report}, wait=False)
 
     return task_id
 
 
-def queue_task(original_filename, f_name, full_path, metadata, rescan=False):
+def queue_task(original_filename, f_name, full_path, metadata, rescan=False, pending=None):
     '''
-    Queue up a single new task, for a single non-archive file.
+    Queue up a single new task, for a single non-archive file. If pending is
+    a list, Celery tasks are added to it for publish_tasks() instead of being
+    published one at a time.
     '''
     # If option set, or no scan exists for this sample, skip and scan sample again
     # Otherwise, pull latest scan for this sample
     if (not rescan):
+        # Ask the DB directly: another API process may have deleted the task
+        # this process has cached
         t_exists = db.exists(f_name)
         if t_exists:
             return t_exists
@@ -402,19 +618,31 @@ def queue_task(original_filename, f_name, full_path, metadata, rescan=False):
     # Add task to sqlite DB
     # Make the sample_id equal the sha256 hash
     task_id = db.add_task(sample_id=f_name)
+    exists_cache.pop(f_name)
 
     if DISTRIBUTED:
-        # Publish the task to Celery
-        multiscanner_celery.delay(full_path, original_filename,
-                                  task_id, f_name, metadata,
-                                  config=multiscanner.CONFIG)
+        args = (full_path, original_filename, task_id, f_name, metadata)
+        if pending is not None:
+            pending.append(multiscanner_celery.s(*args, config=multiscanner.CONFIG))
+        else:
+            # Publish the task to Celery
+            multiscanner_celery.delay(*args, config=multiscanner.CONFIG)
     else:
         # Put the task on the queue
-        work_queue.put((full_path, original_filename, task_id, f_name, metadata))
+        work_queue.put(WorkItem(full_path, original_filename, task_id, f_name, metadata))
 
     return task_id
 
 
+def publish_tasks(pending):
+    '''
+    Publish the Celery tasks collected by queue_task() together, so they
+    share one broker connection rather than each opening their own.
+    '''
+    if pending:
+        group(pending).apply_async()
+
+
 @app.route('/api/v1/tasks', methods=['POST'])
 def create_task():
     '''
@@ -450,7 +678,7 @@ def create_task():
     extract_dir = None
     rescan = False
     for key in request.form.keys():
-        if key in ['file_id', 'archive-password', 'upload_type'] or request.form[key] == '':
+        if key in ['file_id', 'archive-password', 'archive-async', 'upload_type'] or request.form[key] == '':
             continue
         elif key == 'duplicate':
             if request.form[key] == 'latest':
@@ -466,7 +694,7 @@ def create_task():
                 if split[0] in module_names and split[1] == '.py':
                     modules.append(f)
         elif key == 'archive-analyze' and request.form[key] == 'true':
-            extract_dir = api_config['api']['upload_folder']
+            extract_dir = upload_folder
             if not os.path.isdir(extract_dir):
                 return make_response(
                     jsonify({'Message': "'upload_folder' in API config is not "
@@ -483,7 +711,21 @@ def create_task():
         else:
             metadata[key] = request.form[key]
 
-    if extract_dir:
+    if extract_dir and DISTRIBUTED and request.form.get('archive-async') == 'true':
+        # Save the archive as is and let a worker extract it, so large
+        # archives don't tie up this request
+        f_name, full_path = save_hashed_filename(file_)
+        result = extract_archive_celery.delay(
+            full_path, request.form.get('archive-password', ''), metadata,
+            rescan=rescan, config=multiscanner.CONFIG)
+        return make_response(
+            jsonify({'Message': {'archive_task_id': result.id}}),
+            HTTP_ACCEPTED
+        )
+    elif extract_dir:
+        # Only archive uploads need rarfile, so don't load it at startup
+        import rarfile
+        pending = []
         # Extract a zip
         if zipfile.is_zipfile(file_):
             z = zipfile.ZipFile(file_)
@@ -492,30 +734,34 @@ def create_task():
                 # https://docs.python.org/2/library/zipfile.html#zipfile.ZipFile.extract
                 z.extractall(path=extract_dir, pwd=password)
                 for uzfile in z.namelist():
-                    unzipped_file = open(os.path.join(extract_dir, uzfile))
+                    unzipped_file = open(os.path.join(extract_dir, uzfile), 'rb')
                     f_name, full_path = save_hashed_filename(unzipped_file, True)
-                    tid = queue_task(uzfile, f_name, full_path, metadata, rescan=rescan)
+                    tid = queue_task(uzfile, f_name, full_path, metadata, rescan=rescan, pending=pending)
                     task_id_list.append(tid)
             except RuntimeError as e:
                 msg = "ERROR: Failed to extract " + str(file_) + ' - ' + str(e)
                 return make_response(
                     jsonify({'Message': msg}),
                     HTTP_BAD_REQUEST)
+            finally:
+                publish_tasks(pending)
         # Extract a rar
         elif rarfile.is_rarfile(file_):
             r = rarfile.RarFile(file_)
             try:
                 r.extractall(path=extract_dir, pwd=password)
                 for urfile in r.namelist():
-                    unrarred_file = open(os.path.join(extract_dir, urfile))
+                    unrarred_file = open(os.path.join(extract_dir, urfile), 'rb')
                     f_name, full_path = save_hashed_filename(unrarred_file, True)
-                    tid = queue_task(urfile, f_name, full_path, metadata, rescan=rescan)
+                    tid = queue_task(urfile, f_name, full_path, metadata, rescan=rescan, pending=pending)
                     task_id_list.append(tid)
             except RuntimeError as e:
                 msg = "ERROR: Failed to extract " + str(file_) + ' - ' + str(e)
                 return make_response(
                     jsonify({'Message': msg}),
                     HTTP_BAD_REQUEST)
+            finally:
+                publish_tasks(pending)
     else:
         # File was not an archive to extract
         f_name, full_path = save_hashed_filename(file_)
@@ -536,37 +782,38 @@ def get_report(task_id):
     to the given task ID.
     '''
 
-    download = request.args.get('d', default='False', type=str)[0].lower()
+    download = _parse_bool(request.args.get('d'))
 
     report_dict, success = get_report_dict(task_id)
     if success:
-        if (download == 't' or download == 'y' or download == '1'):
+        if download:
             # raw JSON
-            response = make_response(jsonify(report_dict))
-            response.headers['Content-Type'] = 'application/json'
+            response = ojsonify(report_dict)
             response.headers['Content-Disposition'] = 'attachment; filename=%s.json' % task_id
             return response
         else:
             # processed JSON intended for web UI
             report_dict = _pre_process(report_dict)
-            return jsonify(report_dict)
+            return ojsonify(report_dict)
     else:
-        return jsonify(report_dict)
+        return ojsonify(report_dict)
 
 
 def _pre_process(report_dict={}):
     '''
     Returns a JSON dictionary where a series of pre-processing steps are
-    executed on report_dict.
+    executed on report_dict. report_dict itself is left unchanged.
     '''
 
-    # pop unecessary keys
-    if report_dict.get('Report', {}).get('ssdeep', {}):
-        for k in ['chunksize', 'chunk', 'double_chunk']:
-            try:
-                report_dict['Report']['ssdeep'].pop(k)
-            except KeyError as e:
-                pass
+    # drop unecessary keys
+    report = report_dict.get('Report')
+    if report:
+        report = dict(report)
+        for section, keys in REPORT_STRIP_KEYS:
+            section_dict = report.get(section)
+            if section_dict:
+                report[section] = {k: v for k, v in section_dict.items() if k not in keys}
+        report_dict = dict(report_dict, Report=report)
 
     report_dict = _add_links(report_dict)
 
@@ -579,27 +826,25 @@ def _add_links(report_dict):
     with hyperlinks.
     '''
 
-    web_loc = api_config['api']['web_loc']
-
     # ssdeep matches
     matches_dict = report_dict.get('Report', {}) \
                               .get('ssdeep', {}) \
                               .get('matches', {})
 
     if matches_dict:
-        links_dict = {}
+        # Look up the task ids of all matches in one pass
+        task_ids = _tasks_exist(matches_dict)
+        report_url = web_loc + '/report/'
         # k=SHA256, v=ssdeep.compare result
-        for k, v in matches_dict.items():
-            t_id = db.exists(k)
-            if t_id:
-                url = '{h}/report/{t_id}'.format(h=web_loc, t_id=t_id)
-                href = _linkify(k, url, True)
-                links_dict[href] = v
-            else:
-                links_dict[k] = v
+        links_dict = {
+            (_linkify(k, report_url + str(task_ids[k]), True) if k in task_ids else k): v
+            for k, v in matches_dict.items()
+        }
 
-        # replace with updated dict
-        report_dict['Report']['ssdeep']['matches'] = links_dict
+        # replace with updated dict, copying so cached reports aren't changed
+        report = dict(report_dict['Report'])
+        report['ssdeep'] = dict(report['ssdeep'], matches=links_dict)
+        report_dict = dict(report_dict, Report=report)
 
     return report_dict
 
@@ -648,25 +893,47 @@ def get_maec_report(task_id):
 
     # Get the MAEC report from Cuckoo
     try:
-        maec_report = requests.get(
-            '{}/v1/tasks/report/{}/maec'.format(ms_config.get('Cuckoo', {}).get('API URL', ''), cuckoo_task_id)
+        maec_report = cuckoo_session.get(
+            '{}/v1/tasks/report/{}/maec'.format(ms_config.get('Cuckoo', {}).get('API URL', ''), cuckoo_task_id),
+            timeout=CUCKOO_TIMEOUT
         )
     except:
         return jsonify({'Error': 'No MAEC report found for that task!'})
-    # raw JSON
-    response = make_response(jsonify(maec_report.json()))
+    if not maec_report.ok:
+        return jsonify({'Error': 'No MAEC report found for that task!'})
+    # raw JSON, passed through as Cuckoo sent it rather than parsed and
+    # re-encoded
+    response = make_response(maec_report.content)
     response.headers['Content-Type'] = 'application/json'
     response.headers['Content-Disposition'] = 'attachment; filename=%s.json' % task_id
     return response
 
 
+def clear_report_caches():
+    '''
+    Forget cached reports and anything rendered from them, after a change
+    to stored reports.
+    '''
+    report_cache.clear()
+    pdf_cache.clear()
+
+
 def get_report_dict(task_id):
     task = db.get_task(task_id)
     if not task:
         abort(HTTP_NOT_FOUND)
+    return _report_dict_for_task(task)
+
 
+def _report_dict_for_task(task):
     if task.task_status == 'Complete':
-        return {'Report': handler.get_report(task.sample_id, task.timestamp)}, True
+        key = (task.sample_id, task.timestamp)
+        report = report_cache.get(key)
+        if report is None:
+            report = handler.get_report(task.sample_id, task.timestamp)
+            if report is not None:
+                report_cache.set(key, report)
+        return {'Report': report}, True
     elif task.task_status == 'Pending':
         return {'Report': 'Task still pending'}, False
     else:
@@ -683,7 +950,8 @@ def delete_report(task_id):
         abort(HTTP_NOT_FOUND)
 
     if handler.delete(task.report_id):
-        return jsonify({'Message': 'Deleted'})
+        clear_report_caches()
+        return canned_response(DELETED_BODY)
     else:
         abort(HTTP_NOT_FOUND)
 
@@ -693,8 +961,11 @@ def taglist():
     '''
     Return a list of all tags currently in use.
     '''
-    response = handler.get_tags()
-    return jsonify({'Tags': response})
+    response = tags_cache.get('tags')
+    if response is None:
+        response = handler.get_tags()
+        tags_cache.set('tags', response)
+    return ojsonify({'Tags': response})
 
 
 @app.route('/api/v1/tasks/<task_id>/tags', methods=['POST', 'DELETE'])
@@ -712,13 +983,25 @@ def tags(task_id):
         response = handler.add_tag(task.sample_id, tag)
         if not response:
             abort(HTTP_BAD_REQUEST)
-        return jsonify({'Message': 'Tag Added'})
+        _tags_changed()
+        return canned_response(TAG_ADDED_BODY)
 
     elif request.method == 'DELETE':
         response = handler.remove_tag(task.sample_id, tag)
         if not response:
             abort(HTTP_BAD_REQUEST)
-        return jsonify({'Message': 'Tag Removed'})
+        _tags_changed()
+        return canned_response(TAG_REMOVED_BODY)
+
+
+def _tags_changed():
+    '''
+    Forget cached data that includes tags, after a tag was added or removed.
+    Done after the write so a concurrent read can't re-cache the old tags.
+    '''
+    # Reports include their sample's tags
+    clear_report_caches()
+    tags_cache.clear()
 
 
 @app.route('/api/v1/tasks/<task_id>/notes', methods=['GET'])
@@ -742,12 +1025,12 @@ def get_notes(task_id):
 
     if 'hits' in response and 'hits' in response['hits']:
         response = response['hits']['hits']
-    try:
+        escape = Markup.escape
         for hit in response:
-            hit['_source']['text'] = Markup.escape(hit['_source']['text'])
-    except:
-        pass
-    return jsonify(response)
+            source = hit.get('_source', {})
+            if 'text' in source:
+                source['text'] = escape(source['text'])
+    return ojsonify(response)
 
 
 @app.route('/api/v1/tasks/<task_id>/notes', methods=['POST'])
@@ -791,61 +1074,120 @@ def files_get_sha256(sha256):
     '''
     Returns binary from storage. Defaults to password protected zipfile.
     '''
+    if not SHA256_RE.match(sha256):
+        abort(HTTP_NOT_FOUND)
+
     # is there a robust way to just get this as a bool?
     raw = request.args.get('raw', default='False', type=str)
 
     return files_get_sha256_helper(sha256, raw)
 
 
+def _zip_sample(file_path, arcname):
+    '''
+    Return the bytes of a zip archive, encrypted with the password
+    'infected', that contains only the given file. Built in memory rather
+    than by shelling out to /usr/bin/zip.
+    '''
+    zip_buffer = io.BytesIO()
+    with pyzipper.AESZipFile(zip_buffer, 'w',
+                             compression=pyzipper.ZIP_DEFLATED,
+                             encryption=pyzipper.WZ_AES) as zf:
+        zf.setpassword(b'infected')
+        zf.write(file_path, arcname=arcname)
+    return zip_buffer.getvalue()
+
+
+def _call_with_timeout(args, timeout):
+    '''
+    Run a command and return its exit code, or None if it was killed for
+    running longer than timeout seconds.
+    '''
+    if PY3:
+        try:
+            return subprocess.call(args, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return None
+    # Python 2's subprocess has no timeout, so kill the process from a timer
+    proc = subprocess.Popen(args)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    proc.wait()
+    timer.cancel()
+    if proc.returncode == -signal.SIGKILL:
+        return None
+    return proc.returncode
+
+
 def files_get_sha256_helper(sha256, raw=None):
     '''
     Returns binary from storage. Defaults to password protected zipfile.
     '''
-    file_path = os.path.join(api_config['api']['upload_folder'], sha256)
+    file_path = os.path.join(upload_folder, sha256)
     if not os.path.exists(file_path):
         abort(HTTP_NOT_FOUND)
 
-    with open(file_path, "rb") as fh:
-        fh_content = fh.read()
-
-    raw = raw[0].lower()
-    if raw == 't' or raw == 'y' or raw == '1':
-        response = make_response(fh_content)
+    if _parse_bool(raw):
+        # Let werkzeug stream the file (and answer conditional/Range requests)
+        # rather than reading the whole sample into memory
+        # send_file resolves relative paths against app.root_path, not the
+        # working directory the exists() check above used
+        response = send_file(os.path.abspath(file_path),
+                             mimetype='application/octet-stream',
+                             conditional=True)
         response.headers['Content-Type'] = 'application/octet-stream; charset=UTF-8'
         response.headers['Content-Disposition'] = 'inline; filename={}.bin'.format(sha256)  # better way to include fname?
+        return response
+
+    rawname = sha256 + '.bin'
+    if pyzipper:
+        zip_data = _zip_sample(file_path, rawname)
     else:
         # ref: https://github.com/crits/crits/crits/core/data_tools.py#L122
-        rawname = sha256 + '.bin'
-        with open(os.path.join('/tmp/', rawname), 'wb') as raw_fh:
-            raw_fh.write(fh_content)
-
-        zipname = sha256 + '.zip'
-        args = ['/usr/bin/zip', '-j',
-                os.path.join('/tmp', zipname),
-                os.path.join('/tmp', rawname),
-                '-P', 'infected']
-        proc = subprocess.Popen(args)
-        wait_seconds = 30
-        while proc.poll() is None and wait_seconds:
-            time.sleep(1)
-            wait_seconds -= 1
-
-        if proc.returncode:
-            return make_response(jsonify({'Error': 'Failed to create zip ()'.format(proc.returncode)}))
-        elif not wait_seconds:
-            proc.terminate()
-            return make_response(jsonify({'Error': 'Process timed out'}))
-        else:
-            with open(os.path.join('/tmp', zipname), 'rb') as zip_fh:
+        # Work in a private dir so concurrent downloads of one sample don't
+        # share files, and link the sample in rather than copying it
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.symlink(os.path.abspath(file_path), os.path.join(tmp_dir, rawname))
+            zipname = sha256 + '.zip'
+            args = ['/usr/bin/zip', '-j',
+                    os.path.join(tmp_dir, zipname),
+                    os.path.join(tmp_dir, rawname),
+                    '-P', 'infected']
+            returncode = _call_with_timeout(args, ZIP_TIMEOUT)
+            if returncode is None:
+                return make_response(jsonify({'Error': 'Process timed out'}), HTTP_SERVER_ERROR)
+            elif returncode:
+                return make_response(jsonify({'Error': 'Failed to create zip ({})'.format(returncode)}), HTTP_SERVER_ERROR)
+            with open(os.path.join(tmp_dir, zipname), 'rb') as zip_fh:
                 zip_data = zip_fh.read()
-            if len(zip_data) == 0:
-                return make_response(jsonify({'Error': 'Zip file empty'}))
-            response = make_response(zip_data)
-            response.headers['Content-Type'] = 'application/zip; charset=UTF-8'
-            response.headers['Content-Disposition'] = 'inline; filename={}.zip'.format(sha256)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if len(zip_data) == 0:
+        return make_response(jsonify({'Error': 'Zip file empty'}))
+    response = make_response(zip_data)
+    response.headers['Content-Type'] = 'application/zip; charset=UTF-8'
+    response.headers['Content-Disposition'] = 'inline; filename={}.zip'.format(sha256)
     return response
 
 
+def get_ssdeep_analytic():
+    '''
+    Return the SSDeepAnalytic shared by the analytics endpoints, creating it
+    on first use. Creating one loads the storage modules and connects to
+    Elasticsearch, so it isn't done per request. Sharing it between request
+    threads is safe: its methods only read the attributes set in __init__,
+    and the Elasticsearch client it holds is thread safe.
+    '''
+    global ssdeep_analytic
+    with ssdeep_analytic_lock:
+        if ssdeep_analytic is None:
+            from ssdeep_analytics import SSDeepAnalytic
+            ssdeep_analytic = SSDeepAnalytic()
+    return ssdeep_analytic
+
+
 @app.route('/api/v1/analytics/ssdeep_compare', methods=['GET'])
 def run_ssdeep_compare():
     '''
@@ -855,11 +1197,11 @@ def run_ssdeep_compare():
         if DISTRIBUTED:
             # Publish task to Celery
             ssdeep_compare_celery.delay()
-            return make_response(jsonify({ 'Message': 'Success' }))
+            return canned_response(SUCCESS_BODY)
         else:
-            ssdeep_analytic = SSDeepAnalytic()
-            ssdeep_analytic.ssdeep_compare()
-            return make_response(jsonify({ 'Message': 'Success' }))
+            get_ssdeep_analytic().ssdeep_compare()
+            clear_report_caches()
+            return canned_response(SUCCESS_BODY)
     except Exception as e:
         return make_response(
             jsonify({'Message': 'Unable to complete request.'}),
@@ -872,8 +1214,7 @@ def run_ssdeep_group():
     Runs ssdeep group analytic and returns list of groups as a list.
     '''
     try:
-        ssdeep_analytic = SSDeepAnalytic()
-        groups = ssdeep_analytic.ssdeep_group()
+        groups = get_ssdeep_analytic().ssdeep_group()
         return make_response(jsonify({ 'groups': groups }))
     except Exception as e:
         return make_response(
@@ -881,17 +1222,91 @@ def run_ssdeep_group():
             HTTP_BAD_REQUEST)
 
 
+def _read_rendered_pdf(task):
+    '''
+    Return the PDF that render_pdf_celery wrote for task, or None if it
+    isn't there yet.
+    '''
+    try:
+        with open(rendered_pdf_path(task.task_id, task.timestamp), 'rb') as pdf_fh:
+            return pdf_fh.read()
+    except (IOError, OSError):
+        return None
+
+
+def _pdf_render_failed(task):
+    '''
+    Return True if render_pdf_celery failed to render task's PDF in the last
+    PDF_RENDER_TIMEOUT seconds.
+    '''
+    marker = rendered_pdf_path(task.task_id, task.timestamp) + PDF_FAILED_SUFFIX
+    try:
+        return time.time() - os.path.getmtime(marker) < PDF_RENDER_TIMEOUT
+    except OSError:
+        return False
+
+
+def _claim_pdf_render(task):
+    '''
+    Return True if the caller should queue render_pdf_celery for task, i.e.
+    no API process has queued it in the last PDF_RENDER_TIMEOUT seconds.
+    The claim is a marker file next to the PDF, so it holds across
+    processes; the worker removes it when it's done.
+    '''
+    marker = rendered_pdf_path(task.task_id, task.timestamp) + PDF_PENDING_SUFFIX
+    try:
+        os.makedirs(os.path.dirname(marker))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(marker)):
+            raise
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        pass
+    try:
+        if time.time() - os.path.getmtime(marker) < PDF_RENDER_TIMEOUT:
+            return False
+    except OSError:
+        # The worker just finished and removed it
+        return False
+    # The render seems to have been lost; take over the claim
+    os.utime(marker, None)
+    return True
+
+
 @app.route('/api/v1/tasks/<task_id>/pdf', methods=['GET'])
 def get_pdf_report(task_id):
     '''
     Generates a PDF version of a JSON report.
     '''
-    report_dict, success = get_report_dict(task_id)
+    task = db.get_task(task_id)
+    if not task:
+        abort(HTTP_NOT_FOUND)
 
-    if not success:
-        return jsonify(report_dict)
+    cache_key = (task.task_id, task.sample_id, task.timestamp)
+    pdf = pdf_cache.get(cache_key)
+    if pdf is None and DISTRIBUTED and _parse_bool(request.args.get('async')):
+        # Pending and failed tasks fall through to the usual message below
+        if task.task_status == 'Complete':
+            pdf = _read_rendered_pdf(task)
+            if pdf is None:
+                if _pdf_render_failed(task):
+                    return canned_response(PDF_FAILED_BODY, HTTP_SERVER_ERROR)
+                if _claim_pdf_render(task):
+                    render_pdf_celery.delay(task.task_id)
+                return canned_response(PDF_RENDERING_BODY, HTTP_ACCEPTED)
+            pdf_cache.set(cache_key, pdf)
+    if pdf is None:
+        report_dict, success = _report_dict_for_task(task)
+
+        if not success:
+            return jsonify(report_dict)
 
-    pdf = create_pdf_document(MS_WD, report_dict)
+        # reportlab is slow to import and only needed here
+        from utils.pdf_generator import create_pdf_document
+        pdf = create_pdf_document(MS_WD, report_dict)
+        pdf_cache.set(cache_key, pdf)
     response = make_response(pdf)
     response.headers['Content-Type'] = 'application/pdf'
     response.headers['Content-Disposition'] = 'attachment; filename=%s.pdf' % task_id
@@ -900,9 +1315,9 @@ def get_pdf_report(task_id):
 
 if __name__ == '__main__':
 
-    if not os.path.isdir(api_config['api']['upload_folder']):
+    if not os.path.isdir(upload_folder):
         print('Creating upload dir')
-        os.makedirs(api_config['api']['upload_folder'])
+        os.makedirs(upload_folder)
 
     if not DISTRIBUTED:
         exit_signal = multiprocessing.Value('b')
@@ -7,6 +7,10 @@ from the utils/ directory.
 import os
 import sys
 import codecs
+import hashlib
+import shutil
+import time
+import zipfile
 import configparser
 from datetime import datetime
 from socket import gethostname
@@ -25,12 +29,21 @@ if os.path.join(MS_WD, 'analytics') not in sys.path:
 import multiscanner
 import common
 import sql_driver as database
+import elasticsearch_storage
 from celery_batches import Batches
-from ssdeep_analytics import SSDeepAnalytic
 
-from celery import Celery
+from celery import Celery, group
 from celery.schedules import crontab
 
+# Suffix of the marker file the REST API creates next to a PDF it has
+# queued render_pdf_celery for; removed once the render is done
+PDF_PENDING_SUFFIX = '.pending'
+# Suffix of the marker file render_pdf_celery leaves when a render fails, so
+# the API reports the error rather than queueing the same render again
+PDF_FAILED_SUFFIX = '.failed'
+# Seconds rendered PDFs are kept before clean_rendered_pdfs_celery removes them
+RENDERED_PDF_MAX_AGE = 24 * 60 * 60
+
 DEFAULTCONF = {
     'protocol': 'pyamqp',
     'host': 'localhost',
@@ -77,6 +90,11 @@ def setup_periodic_tasks(sender, **kwargs):
         crontab(hour=2, minute=0),
         ssdeep_compare_celery.s(),
     )
+    # Executes every morning at 3:00 a.m.
+    sender.add_periodic_task(
+        crontab(hour=3, minute=0),
+        clean_rendered_pdfs_celery.s(),
+    )
 
 def celery_task(files, config=multiscanner.CONFIG):
     '''
@@ -169,6 +187,163 @@ def multiscanner_celery(requests, *args, **kwargs):
 
     celery_task(files)
 
+@app.task()
+def extract_archive_celery(archive_path, password, metadata, rescan=False,
+                           config=multiscanner.CONFIG):
+    '''
+    Extract a zip or rar archive submitted to the REST API and queue a
+    multiscanner task for every file in it. Returns the list of task ids.
+
+    Usage:
+    from celery_worker import extract_archive_celery
+    extract_archive_celery.delay(archive_path, password, metadata, rescan)
+    '''
+    # Imported here so the API, which imports this module, doesn't load it
+    import rarfile
+    db.init_db()
+
+    extract_dir = api_config['upload_folder']
+    if password:
+        password = password.encode('utf-8')
+    else:
+        password = None
+
+    if zipfile.is_zipfile(archive_path):
+        archive = zipfile.ZipFile(archive_path)
+    elif rarfile.is_rarfile(archive_path):
+        archive = rarfile.RarFile(archive_path)
+    else:
+        print('{} is not a zip or rar archive'.format(archive_path))
+        return []
+
+    archive.extractall(path=extract_dir, pwd=password)
+    task_ids = []
+    pending = []
+    for original_filename in archive.namelist():
+        extracted_path = os.path.join(extract_dir, original_filename)
+        if os.path.isdir(extracted_path):
+            continue
+        # Save the file under its SHA256 hash, like the REST API does
+        file_hash = common.hashfile(extracted_path, hashlib.sha256())
+        full_path = os.path.join(MS_WD, extract_dir, file_hash)
+        shutil.copy2(extracted_path, full_path)
+
+        task_id = None if rescan else db.exists(file_hash)
+        if not task_id:
+            task_id = db.add_task(sample_id=file_hash)
+            pending.append(multiscanner_celery.s(full_path, original_filename,
+                                                 task_id, file_hash, metadata,
+                                                 config=config))
+        task_ids.append(task_id)
+    # Publish them all over one connection instead of one per file
+    if pending:
+        group(pending).apply_async()
+    return task_ids
+
+
+def rendered_pdf_dir():
+    '''
+    Return the folder, shared with the REST API, that rendered PDFs go in.
+    '''
+    return os.path.join(api_config['upload_folder'], 'pdf')
+
+
+def rendered_pdf_path(task_id, timestamp):
+    '''
+    Return where render_pdf_celery leaves the PDF report of a task. The
+    task's timestamp is part of the name, so a reused task id never picks up
+    another scan's PDF.
+    '''
+    return os.path.join(rendered_pdf_dir(), '{}_{:%Y%m%dT%H%M%S%f}.pdf'.format(task_id, timestamp))
+
+
+@app.task()
+def render_pdf_celery(task_id, config=multiscanner.CONFIG):
+    '''
+    Render the PDF version of a completed task's report and save it to
+    rendered_pdf_path() for the REST API to serve. The file is left in place
+    for every API process; clean_rendered_pdfs_celery removes old ones.
+
+    Usage:
+    from celery_worker import render_pdf_celery
+    render_pdf_celery.delay(task_id)
+    '''
+    db.init_db()
+
+    task = db.get_task(task_id)
+    if not task or task.task_status != 'Complete':
+        return
+
+    pdf_path = rendered_pdf_path(task.task_id, task.timestamp)
+    storage_handler = None
+    try:
+        if os.path.isfile(pdf_path):
+            # Already rendered by an earlier job
+            return
+
+        storage_conf = multiscanner.common.get_config_path(config, 'storage')
+        storage_handler = multiscanner.storage.StorageHandler(configfile=storage_conf)
+        for handler in storage_handler.loaded_storage:
+            if isinstance(handler, elasticsearch_storage.ElasticSearchStorage):
+                break
+        else:
+            raise RuntimeError('No ElasticSearch storage loaded')
+        report = handler.get_report(task.sample_id, task.timestamp)
+        if report is None:
+            raise RuntimeError('Report for task {} not found'.format(task_id))
+
+        # reportlab is slow to import and only needed here
+        from utils.pdf_generator import create_pdf_document
+        pdf = create_pdf_document(MS_WD, {'Report': report})
+
+        # Write under a temporary name so the API never reads a partial file
+        tmp_path = '{}.{}.tmp'.format(pdf_path, os.getpid())
+        with open(tmp_path, 'wb') as pdf_fh:
+            pdf_fh.write(pdf)
+        os.rename(tmp_path, pdf_path)
+        try:
+            os.remove(pdf_path + PDF_FAILED_SUFFIX)
+        except OSError:
+            pass
+    except Exception:
+        # Tell the API this render failed, so it returns an error until
+        # PDF_RENDER_TIMEOUT has passed instead of queueing it again
+        with open(pdf_path + PDF_FAILED_SUFFIX, 'w'):
+            pass
+        raise
+    finally:
+        if storage_handler is not None:
+            storage_handler.close()
+        try:
+            os.remove(pdf_path + PDF_PENDING_SUFFIX)
+        except OSError:
+            pass
+
+
+@app.task()
+def clean_rendered_pdfs_celery():
+    '''
+    Remove rendered PDFs, and stale pending and failure markers, older than
+    RENDERED_PDF_MAX_AGE seconds.
+
+    Usage:
+    from celery_worker import clean_rendered_pdfs_celery
+    clean_rendered_pdfs_celery.delay()
+    '''
+    pdf_dir = rendered_pdf_dir()
+    if not os.path.isdir(pdf_dir):
+        return
+    oldest = time.time() - RENDERED_PDF_MAX_AGE
+    for name in os.listdir(pdf_dir):
+        path = os.path.join(pdf_dir, name)
+        try:
+            if os.path.getmtime(path) < oldest:
+                os.remove(path)
+        except OSError:
+            # Removed by someone else in the meantime
+            pass
+
+
 @app.task()
 def ssdeep_compare_celery():
     '''
@@ -178,6 +353,8 @@ def ssdeep_compare_celery():
     from celery_worker import ssdeep_compare_celery
     ssdeep_compare_celery.delay()
     '''
+    # Imported here so the API, which imports this module, doesn't load it
+    from ssdeep_analytics import SSDeepAnalytic
     ssdeep_analytic = SSDeepAnalytic()
     ssdeep_analytic.ssdeep_compare()
 
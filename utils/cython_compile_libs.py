@@ -3,7 +3,8 @@ from __future__ import division, absolute_import, with_statement, print_function
 import os
 import sys
 import shutil
-from pyximport.pyxbuild import pyx_to_dll
+import sysconfig
+import multiprocessing
 WD = os.path.dirname(os.path.dirname((os.path.abspath(__file__))))
 LIBS = os.path.join(WD, 'libs')
 # Adds the libs directory to the path
@@ -11,6 +12,44 @@ sys.path.append(LIBS)
 import common
 
 
+def _compile(filename):
+    """
+    Compiles a single .py file in place. Returns (filename, success).
+    """
+    # Imported here so _up_to_date can be used without Cython installed
+    from pyximport.pyxbuild import pyx_to_dll
+    try:
+        pyx_to_dll(filename, inplace=True)
+        success = True
+    except Exception as e:
+        success = False
+    try:
+        os.remove(filename[:-2] + 'c')
+    except:
+        pass
+    return filename, success
+
+
+def _up_to_date(filename):
+    """
+    Returns True if filename already has a compiled module for this
+    interpreter and none of them are older than it. Modules built for other
+    Python versions don't count.
+    """
+    base = filename[:-3]
+    ext_suffix = sysconfig.get_config_var('EXT_SUFFIX')
+    if ext_suffix:
+        candidates = [base + ext_suffix]
+    else:
+        # Python 2 names extension modules without an ABI tag
+        candidates = [base + '.so', base + '.pyd']
+    compiled = [path for path in candidates if os.path.exists(path)]
+    if not compiled:
+        return False
+    source_mtime = os.path.getmtime(filename)
+    return all(os.path.getmtime(path) >= source_mtime for path in compiled)
+
+
 def main():
     filelist = common.parseFileList([LIBS], recursive=True)
     try:
@@ -19,18 +58,25 @@ def main():
         filelist.append(filepath)
     except:
         print('pefile not installed...')
+    filelist = [str(filename) for filename in filelist if filename.endswith('.py')]
+    stale = []
     for filename in filelist:
-        if filename.endswith('.py'):
-            filename = str(filename)
-            try:
-                pyx_to_dll(filename, inplace=True)
+        if _up_to_date(filename):
+            print(filename, 'up to date, skipping')
+        else:
+            stale.append(filename)
+
+    # Each compile runs the C compiler and is independent of the others
+    pool = multiprocessing.Pool()
+    try:
+        for filename, success in pool.imap_unordered(_compile, stale):
+            if success:
                 print(filename, 'successful!')
-            except Exception as e:
+            else:
                 print('ERROR:', filename, 'failed')
-            try:
-                os.remove(filename[:-2] + 'c')
-            except:
-                pass
+    finally:
+        pool.close()
+        pool.join()
 
     # Cleanup build dirs
     walk = os.walk(LIBS)